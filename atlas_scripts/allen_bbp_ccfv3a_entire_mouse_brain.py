@@ -6,9 +6,16 @@ including reference volumes, annotations, and structure information,
 from a Zenodo archive.
 """
 
+import gc
 import json
+import os
+import queue
 import shutil
+import threading
+import time
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import nrrd
@@ -21,9 +28,15 @@ from tqdm import tqdm
 from brainglobe_atlasapi.atlas_generation.mesh_utils import (
     construct_meshes_from_annotation,
 )
+from brainglobe_atlasapi.atlas_generation.volume_utils import (
+    get_label_counts,
+)
 from brainglobe_atlasapi.atlas_generation.wrapup import wrapup_atlas_from_data
 
-VERSION = 0
+# Version 1 changes the packaged data: the 25um reference is aligned with
+# the annotation, and region meshes use closing_n_iters=2 (version 0
+# passed ROOT_ID there by mistake)
+VERSION = 1
 NAME = "ccfv3augmented_mouse"
 CITATION = "https://doi.org/10.1101/2024.11.06.622212"
 ATLAS_LINK = "https://zenodo.org/api/records/14034334/files-archive"
@@ -33,6 +46,372 @@ ROOT_ID = 997
 ATLAS_PACKAGER = "Harry Carey"
 
 
+def stream_response_to_file(response, file_path, chunk_size=4 * 1024 * 1024):
+    """
+    Write a streamed HTTP response to disk.
+
+    Chunks are handed to a writer thread through a bounded queue, so that
+    reading from the network and writing to disk overlap.
+
+    Parameters
+    ----------
+    response : requests.Response
+        Response of a request made with `stream=True`.
+    file_path : Path
+        Path of the file to write.
+    chunk_size : int
+        Size in bytes of the chunks read from the response.
+    """
+    chunks = queue.Queue(maxsize=16)
+    write_errors = []
+
+    def write_chunks():
+        received_all_chunks = False
+        try:
+            with open(file_path, "wb") as f:
+                while (chunk := chunks.get()) is not None:
+                    f.write(chunk)
+                received_all_chunks = True
+        except OSError as e:
+            write_errors.append(e)
+            # keep draining the queue so the reading side never blocks
+            if not received_all_chunks:
+                while chunks.get() is not None:
+                    pass
+
+    # Get file size in bytes, falling back to the known size (21.5GB)
+    total_size = int(
+        response.headers.get("content-length", 21.5 * 1024 * 1024 * 1024)
+    )
+    writer = threading.Thread(target=write_chunks)
+    writer.start()
+    try:
+        with tqdm(
+            total=total_size, unit="B", unit_scale=True, desc="Downloading"
+        ) as pbar:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if write_errors:
+                    break
+                if chunk:
+                    chunks.put(chunk)
+                    pbar.update(len(chunk))
+    finally:
+        chunks.put(None)
+        writer.join()
+    if write_errors:
+        raise write_errors[0]
+
+
+def get_ranged_download_size(url):
+    """
+    Return the size of a download if the server accepts byte range requests.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file to download.
+
+    Returns
+    -------
+    int or None
+        Size of the file in bytes, or None if the size is unknown, the
+        server does not advertise support for range requests or rejects
+        the HEAD request.
+    """
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=60)
+    except requests.RequestException:
+        return None
+    if not response.ok:
+        return None
+    total_size = int(response.headers.get("content-length", 0))
+    if response.headers.get("accept-ranges") != "bytes" or total_size == 0:
+        return None
+    return total_size
+
+
+def get_range_progress_path(file_path):
+    """
+    Return the path of the file recording the progress of a ranged download.
+
+    Parameters
+    ----------
+    file_path : Path
+        Path of the file being downloaded.
+
+    Returns
+    -------
+    Path
+        Path of the JSON file next to `file_path`.
+    """
+    return file_path.with_name(file_path.name + ".ranges.json")
+
+
+def is_retryable_http_error(error):
+    """
+    Check whether an HTTP error is worth retrying after a pause.
+
+    Servers answer 429 when throttling clients and 5xx when temporarily
+    unavailable, whereas other errors (e.g. 404) won't go away by waiting.
+
+    Parameters
+    ----------
+    error : requests.HTTPError
+        The error raised by `raise_for_status`.
+
+    Returns
+    -------
+    bool
+        True if the request should be retried.
+    """
+    # a Response is falsy for error statuses, so compare it to None
+    if error.response is None:
+        return False
+    status_code = error.response.status_code
+    return status_code == 429 or status_code >= 500
+
+
+def download_in_ranges(
+    url,
+    file_path,
+    total_size,
+    n_connections=8,
+    chunk_size=4 * 1024 * 1024,
+    max_retries=8,
+    backoff_factor=1.0,
+):
+    """
+    Download a file over several connections, one per byte range.
+
+    Many data portals throttle each connection rather than each client,
+    so fetching disjoint ranges in parallel increases throughput. If a
+    connection drops, or the server answers 429 or 5xx, the range is
+    requested again after an exponentially increasing pause, from the last
+    byte written rather than from its start.
+
+    The next byte to download in each range is recorded in a JSON file
+    next to `file_path` (see `get_range_progress_path`), so a download
+    interrupted in an earlier run continues where it stopped. The JSON file
+    is deleted once the download is complete.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file to download.
+    file_path : Path
+        Path of the file to write.
+    total_size : int
+        Size of the file in bytes.
+    n_connections : int
+        Number of ranges downloaded in parallel.
+    chunk_size : int
+        Size in bytes of the chunks read from each response.
+    max_retries : int
+        Number of consecutive failed attempts after which a range is
+        given up on. The count is reset whenever data is received.
+    backoff_factor : float
+        Pause in seconds before the first retry, doubled for each
+        consecutive retry.
+
+    Raises
+    ------
+    ValueError
+        If the server ignores the range header and returns the whole file.
+    requests.ConnectionError
+        If a range is still incomplete after `max_retries` retries.
+    requests.HTTPError
+        If the server answers with an error that is not worth retrying.
+    """
+    progress_path = get_range_progress_path(file_path)
+    ranges = None
+    if progress_path.exists() and file_path.exists():
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress["total_size"] == total_size:
+            ranges = progress["ranges"]
+    if ranges is None:
+        # Each range is [next byte to download, last byte of the range]
+        range_size = -(-total_size // n_connections)
+        ranges = [
+            [start, min(start + range_size, total_size) - 1]
+            for start in range(0, total_size, range_size)
+        ]
+        with open(file_path, "wb") as f:
+            f.truncate(total_size)
+
+    progress_lock = threading.Lock()
+
+    def save_progress():
+        temporary_path = progress_path.with_name(progress_path.name + ".tmp")
+        with open(temporary_path, "w") as f:
+            json.dump({"total_size": total_size, "ranges": ranges}, f)
+        os.replace(temporary_path, progress_path)
+
+    save_progress()
+    downloaded = total_size - sum(end + 1 - offset for offset, end in ranges)
+    with tqdm(
+        total=total_size,
+        initial=downloaded,
+        unit="B",
+        unit_scale=True,
+        desc="Downloading",
+    ) as pbar:
+
+        def download_range(byte_range):
+            end = byte_range[1]
+            n_retries = 0
+            while byte_range[0] <= end:
+                headers = {"Range": f"bytes={byte_range[0]}-{end}"}
+                try:
+                    with requests.get(
+                        url, headers=headers, stream=True, timeout=60
+                    ) as response:
+                        response.raise_for_status()
+                        if response.status_code != 206:
+                            raise ValueError(
+                                f"Range requests not supported by {url}"
+                            )
+                        with open(file_path, "r+b") as f:
+                            f.seek(byte_range[0])
+                            for chunk in response.iter_content(
+                                chunk_size=chunk_size
+                            ):
+                                f.write(chunk)
+                                # only record bytes that reached the OS
+                                f.flush()
+                                with progress_lock:
+                                    byte_range[0] += len(chunk)
+                                    save_progress()
+                                    pbar.update(len(chunk))
+                                n_retries = 0
+                    if byte_range[0] <= end:
+                        raise requests.ConnectionError(
+                            "Connection closed before the end of the range"
+                        )
+                except (
+                    requests.ConnectionError,
+                    requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.HTTPError,
+                ) as e:
+                    if isinstance(
+                        e, requests.HTTPError
+                    ) and not is_retryable_http_error(e):
+                        raise
+                    if n_retries == max_retries:
+                        raise requests.ConnectionError(
+                            f"Could not download bytes "
+                            f"{byte_range[0]}-{end} of {url}"
+                        ) from e
+                    time.sleep(backoff_factor * 2**n_retries)
+                    n_retries += 1
+
+        try:
+            with ThreadPoolExecutor(max_workers=n_connections) as executor:
+                # list() re-raises the first exception from the workers
+                list(executor.map(download_range, ranges))
+        except ValueError:
+            # The file will be downloaded in one go instead
+            progress_path.unlink(missing_ok=True)
+            raise
+    progress_path.unlink()
+
+
+def get_zip_member_path(extract_dir, member):
+    """
+    Determine where `zipfile.ZipFile.extract` writes a zip member.
+
+    As in `zipfile`, absolute paths are made relative and "." and ".."
+    components are dropped, so members are always extracted inside
+    extract_dir.
+
+    Parameters
+    ----------
+    extract_dir : Path
+        Directory the members are extracted to.
+    member : zipfile.ZipInfo
+        Member of the zip archive.
+
+    Returns
+    -------
+    Path
+        Path the member is extracted to.
+
+    Raises
+    ------
+    ValueError
+        If the path is outside extract_dir.
+    """
+    arcname = member.filename.replace("/", os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    parts = [
+        part
+        for part in arcname.split(os.path.sep)
+        if part not in ("", os.path.curdir, os.path.pardir)
+    ]
+    member_path = Path(extract_dir, *parts).resolve()
+    if not member_path.is_relative_to(Path(extract_dir).resolve()):
+        raise ValueError(f"{member.filename} is outside {extract_dir}")
+    return member_path
+
+
+def extract_zip_in_parallel(zip_path, extract_dir, max_workers=None):
+    """
+    Extract all members of a zip archive, several members at a time.
+
+    Zip members are compressed independently and zlib releases the GIL
+    while decompressing, so extracting members from several threads
+    speeds up extraction of large archives. `zipfile.ZipFile` objects are
+    not safe to share between threads, so each thread opens its own.
+
+    Parameters
+    ----------
+    zip_path : Path
+        Path of the zip archive.
+    extract_dir : Path
+        Directory the members are extracted to.
+    max_workers : int, optional
+        Number of extraction threads, by default `os.cpu_count()`.
+    """
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        members = zip_ref.infolist()
+    # Create the directories upfront, as concurrent extractions creating
+    # the same parent directory can race
+    for member in members:
+        member_path = get_zip_member_path(extract_dir, member)
+        if member.is_dir():
+            member_path.mkdir(parents=True, exist_ok=True)
+        else:
+            member_path.parent.mkdir(parents=True, exist_ok=True)
+    # Start with the largest members so that threads finish together
+    members = sorted(
+        (member for member in members if not member.is_dir()),
+        key=lambda member: member.file_size,
+        reverse=True,
+    )
+
+    thread_data = threading.local()
+    open_zip_files = []
+    open_zip_files_lock = threading.Lock()
+
+    def extract_member(member):
+        if not hasattr(thread_data, "zip_ref"):
+            thread_data.zip_ref = zipfile.ZipFile(zip_path, "r")
+            with open_zip_files_lock:
+                open_zip_files.append(thread_data.zip_ref)
+        thread_data.zip_ref.extract(member, extract_dir)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # list() re-raises the first exception from the workers
+            list(executor.map(extract_member, members))
+    finally:
+        for zip_ref in open_zip_files:
+            zip_ref.close()
+
+
 def download_resources(download_dir_path, atlas_file_url, atlas_name):
     """
     Download necessary resources for the atlas.
@@ -50,6 +429,13 @@ def download_resources(download_dir_path, atlas_file_url, atlas_name):
     -----
     `pooch` was initially attempted for downloading, but it failed to download
     the entire file. Therefore, `requests` is used instead.
+
+    When the server supports byte range requests, the archive is
+    downloaded over several connections in parallel. It is downloaded to a
+    ".part" file which is only renamed once the download is complete, so
+    an interrupted download is never mistaken for a complete archive.
+    An interrupted ranged download continues from where it stopped when
+    the script is run again. Archive members are then extracted in parallel.
     """
     if "download=1" not in atlas_file_url:
         atlas_file_url = atlas_file_url + "?download=1"
@@ -57,26 +443,27 @@ def download_resources(download_dir_path, atlas_file_url, atlas_name):
 
     if not file_path.exists():
         # Pooch for some reason refused to download the entire file.
-        response = requests.get(atlas_file_url, stream=True)
-        response.raise_for_status()
-        # Get file size in bytes (21.5GB)
-        total_size = int(21.5 * 1024 * 1024 * 1024)
-        with tqdm(
-            total=total_size, unit="B", unit_scale=True, desc="Downloading"
-        ) as pbar:
-            with open(file_path, "wb") as f:
-                for chunk in response.iter_content(
-                    chunk_size=1024 * 1024
-                ):  # 1MB chunks
-                    if chunk:
-                        f.write(chunk)
-                        pbar.update(len(chunk))
-        with zipfile.ZipFile(file_path, "r") as zip_ref:
-            zip_ref.extractall(download_dir_path)
+        partial_file_path = file_path.with_name(file_path.name + ".part")
+        total_size = get_ranged_download_size(atlas_file_url)
+        if total_size is not None:
+            try:
+                download_in_ranges(
+                    atlas_file_url, partial_file_path, total_size
+                )
+            except ValueError:
+                total_size = None
+        if total_size is None:
+            with requests.get(
+                atlas_file_url, stream=True, timeout=60
+            ) as response:
+                response.raise_for_status()
+                stream_response_to_file(response, partial_file_path)
+            get_range_progress_path(partial_file_path).unlink(missing_ok=True)
+        partial_file_path.rename(file_path)
+        extract_zip_in_parallel(file_path, download_dir_path)
     zipped_template_dir = download_dir_path / "average_nissl_template.zip"
     if not (download_dir_path / "nissl_average_full.nii.gz").exists():
-        with zipfile.ZipFile(zipped_template_dir, "r") as zip_ref:
-            zip_ref.extractall(download_dir_path)
+        extract_zip_in_parallel(zipped_template_dir, download_dir_path)
 
 
 def retrieve_reference_and_annotation(download_path, resolution):
@@ -104,11 +491,21 @@ def retrieve_reference_and_annotation(download_path, resolution):
     hemi-segmentation to create a full volume. The developers provided only
     a 10um population average template, which is downsampled when a
     25um resolution is requested.
+
+    The downsampling maps voxel edges rather than voxel centres. This is
+    a change to the data, not only to performance: the 25um reference
+    of version 1 of the atlas differs from version 0 by up to 7.4um
+    towards its edges, and now lines up with the 25um annotation.
     """
     reference_path = download_path / "nissl_average_full.nii.gz"
     reference = load_any(reference_path)
     if resolution == 25:
-        reference = zoom(reference, 0.4, order=1)
+        # grid_mode maps voxel edges rather than the centres of the corner
+        # voxels, so the downsampled template lines up with the 25um
+        # annotation instead of being stretched by (N - 1) / (M - 1)
+        reference = zoom(
+            reference, 0.4, order=1, grid_mode=True, mode="grid-constant"
+        )
     reference = (reference * 65535).astype(np.uint16)
     reference = reference.transpose(1, 2, 0)[::-1, ::-1]
 
@@ -116,8 +513,8 @@ def retrieve_reference_and_annotation(download_path, resolution):
         download_path / f"annotv3a_bbp_{resolution}.nrrd"
     )
     if resolution == 10:
-        # mirror the volume
-        new_annot = np.zeros(reference.shape)
+        # mirror the volume, keeping the label dtype rather than float64
+        new_annot = np.empty(reference.shape, dtype=annotation.dtype)
         new_annot[:, :, 570:] = annotation
         new_annot[:, :, :570] = annotation[:, :, ::-1]
         annotation = new_annot
@@ -168,36 +565,59 @@ def retrieve_hemisphere_map():
     return None
 
 
-def hex_to_rgb(hex_string):
-    """Convert hex color string to RGB list."""
-    hex_string = hex_string.lstrip("#")
-    return [int(hex_string[i : i + 2], 16) for i in (0, 2, 4)]
+def hex_to_rgb(hex_strings):
+    """
+    Convert hex color strings to an (N, 3) array of RGB values.
+
+    Raises
+    ------
+    ValueError
+        If a string is not made of 6 hex digits, optionally preceded by
+        "#". Checking each string stops a malformed color from shifting
+        the colors after it.
+    """
+    hex_strings = [hex_string.lstrip("#") for hex_string in hex_strings]
+    for hex_string in hex_strings:
+        # bytes.fromhex skips whitespace, so it has to be ruled out too
+        if len(hex_string) != 6 or any(c.isspace() for c in hex_string):
+            raise ValueError(f"Invalid hex color: {hex_string!r}")
+    hex_digits = "".join(hex_strings)
+    return np.frombuffer(bytes.fromhex(hex_digits), dtype=np.uint8).reshape(
+        -1, 3
+    )
 
 
 def flatten_structure_tree(node, structure_id_path=None):
-    """Recursively flatten the tree structure."""
+    """Flatten the tree structure with an iterative pre-order traversal."""
     if structure_id_path is None:
-        structure_id_path = []
-
-    # Create current path
-    current_path = structure_id_path + [node["id"]]
-
-    # Create entry for current node
-    entry = {
-        "id": node["id"],
-        "name": node["name"],
-        "acronym": node["acronym"],
-        "structure_id_path": current_path,
-        "rgb_triplet": hex_to_rgb(node["color_hex_triplet"]),
-    }
-
-    # Start with current node's data
-    entries = [entry]
+        structure_id_path = ()
+
+    entries = []
+    hex_colors = []
+    stack = deque([(node, tuple(structure_id_path))])
+    while stack:
+        current, parent_path = stack.pop()
+        current_path = parent_path + (current["id"],)
+        entries.append(
+            {
+                "id": current["id"],
+                "name": current["name"],
+                "acronym": current["acronym"],
+                "structure_id_path": list(current_path),
+            }
+        )
+        hex_colors.append(current["color_hex_triplet"])
+        # Push children in reverse so they are popped in their original order
+        stack.extend(
+            (child, current_path)
+            for child in reversed(current.get("children", ()))
+        )
 
-    # Recursively process children
-    if "children" in node:
-        for child in node["children"]:
-            entries.extend(flatten_structure_tree(child, current_path))
+    # Decode all colors at once rather than one structure at a time
+    for entry, rgb_triplet in zip(
+        entries, hex_to_rgb(hex_colors).tolist(), strict=True
+    ):
+        entry["rgb_triplet"] = rgb_triplet
 
     return entries
 
@@ -235,11 +655,19 @@ def retrieve_or_construct_meshes(download_path, annotated_volume, structures):
     dict
         A dictionary where keys are structure IDs and values are paths to
         the generated mesh files.
+    numpy.ndarray
+        The labels present in the annotation volume, so that they don't
+        need to be computed again when wrapping up the atlas.
     """
+    labels, _ = get_label_counts(annotated_volume)
     meshes_dict = construct_meshes_from_annotation(
-        download_path, annotated_volume, structures, ROOT_ID
+        download_path,
+        annotated_volume,
+        structures,
+        parallel=True,
+        labels=labels,
     )
-    return meshes_dict
+    return meshes_dict, labels
 
 
 ### If the code above this line has been filled correctly, nothing needs to be
@@ -256,15 +684,22 @@ if __name__ == "__main__":
         reference_volume, annotated_volume = retrieve_reference_and_annotation(
             bg_root_dir, resolution=resolution
         )
-        additional_references = retrieve_additional_references(
-            bg_root_dir, resolution=resolution
-        )
+        # Meshing is the step with the highest memory use and doesn't need
+        # the reference, so keep it on disk until the atlas is wrapped up
+        reference_path = bg_root_dir / "reference_volume.npy"
+        np.save(reference_path, reference_volume)
+        del reference_volume
+        gc.collect()
 
         hemispheres_stack = retrieve_hemisphere_map()
         structures = retrieve_structure_information(bg_root_dir)
-        meshes_dict = retrieve_or_construct_meshes(
+        meshes_dict, annotation_labels = retrieve_or_construct_meshes(
             bg_root_dir, annotated_volume, structures
         )
+        reference_volume = np.load(reference_path, mmap_mode="r")
+        additional_references = retrieve_additional_references(
+            bg_root_dir, resolution=resolution
+        )
         output_filename = wrapup_atlas_from_data(
             atlas_name=NAME,
             atlas_minor_version=VERSION,
@@ -285,7 +720,10 @@ if __name__ == "__main__":
             scale_meshes=True,
             additional_references=additional_references,
             additional_metadata={"atlas_packager": ATLAS_PACKAGER},
+            annotation_labels=annotation_labels,
         )
+        del reference_volume
+        reference_path.unlink()
         # its important we clear the mesh folder between loops in
         # case one resolution creates more regions than the other
         shutil.rmtree(bg_root_dir / "meshes")
@@ -1,11 +1,17 @@
 """Atlas generation script for the Allen Segmentation version of DeMBA."""
 
+import gc
+import hashlib
+import json
+import multiprocessing as mp
 import shutil
 from pathlib import Path
 
+import numpy as np
 import pooch
 from allensdk.api.queries.ontologies_api import OntologiesApi
 from allensdk.core.reference_space_cache import ReferenceSpaceCache
+from brainglobe_utils.general.system import get_num_processes
 from brainglobe_utils.IO.image import load_any
 from scipy.ndimage import zoom
 
@@ -13,6 +19,9 @@ from brainglobe_atlasapi import utils
 from brainglobe_atlasapi.atlas_generation.mesh_utils import (
     construct_meshes_from_annotation,
 )
+from brainglobe_atlasapi.atlas_generation.volume_utils import (
+    get_label_counts,
+)
 from brainglobe_atlasapi.atlas_generation.wrapup import wrapup_atlas_from_data
 
 VERSION = 0
@@ -22,6 +31,17 @@ ATLAS_LINK = "https://doi.org/10.25493/V3AH-HK7"
 SPECIES = "Mus musculus"
 ORIENTATION = "rsa"
 ROOT_ID = 997
+# DeMBA volumes of every age are in Allen CCFv3 space
+SHAPE_UM = (13200, 8000, 11400)
+
+# Meshes are built in bg_root_dir / "mesh_cache" and deleted once their
+# atlas has been packaged. Set to True to keep them, so that reruns of the
+# script skip mesh construction; this keeps a full set of meshes for each
+# of the 106 age and resolution combinations on disk.
+KEEP_MESH_CACHE = False
+MESH_DECIMATE_FRACTION = 0.5
+MESH_CLOSING_N_ITERS = 1
+MESH_SMOOTH = False
 
 TEMPLATE_KEYS = ["acronym", "id", "name", "structure_id_path", "rgb_triplet"]
 
@@ -128,8 +148,10 @@ def retrieve_reference_and_annotation(
     )
     annotation = load_any(annotation_path)
     reference = load_any(reference_path)
-    zoom_factors = tuple(volume_resolution / resolution for _ in range(3))
-    reference = zoom(reference, zoom_factors, order=1)
+    # zoom interpolates every voxel even when the factors are all 1
+    if volume_resolution != resolution:
+        zoom_factors = tuple(volume_resolution / resolution for _ in range(3))
+        reference = zoom(reference, zoom_factors, order=1)
     if annotation.shape != reference.shape:
 
         zoom_factors = tuple(
@@ -156,8 +178,11 @@ def retrieve_additional_references(
             )
         )
         ref = load_any(reference_path)
-        zoom_factors = tuple(volume_resolution / resolution for _ in range(3))
-        ref = zoom(ref, zoom_factors, order=1)
+        if volume_resolution != resolution:
+            zoom_factors = tuple(
+                volume_resolution / resolution for _ in range(3)
+            )
+            ref = zoom(ref, zoom_factors, order=1)
         additional_references[modality] = ref
     return additional_references
 
@@ -174,8 +199,12 @@ def retrieve_hemisphere_map():
     return None
 
 
-def retrieve_structure_information(download_path):
-    """Use the allen ccf 2022 ontology via the allen ontology api."""
+def retrieve_structure_information(download_path, resolution):
+    """
+    Use the allen ccf 2022 ontology via the allen ontology api.
+    The structures are the same for every age and resolution, so this
+    only needs to be called once.
+    """
     spacecache = ReferenceSpaceCache(
         manifest=download_path / "manifest.json",
         # downloaded files are stored relative to here
@@ -201,7 +230,107 @@ def retrieve_structure_information(download_path):
     return structs_with_mesh
 
 
-age_specific_root_dir = None
+def get_mesh_pool_size(resolutions):
+    """
+    Determine how many processes to create the meshes with.
+
+    Each mesh process uses about 7 bytes per voxel of the annotation, so
+    the number of processes is limited by the free memory, for the finest
+    resolution that will be meshed.
+
+    Returns
+    -------
+        int: Number of mesh processes.
+    """
+    n_voxels = max(
+        np.prod([-(-extent // resolution) for extent in SHAPE_UM])
+        for resolution in resolutions
+    )
+    return get_num_processes(
+        ram_needed_per_process=7 * int(n_voxels),
+        n_max_processes=mp.cpu_count() - 1,
+        fraction_free_ram=0.05,
+    )
+
+
+def get_mesh_cache_dir(download_dir_path, annotated_volume, structures):
+    """
+    Determine the folder caching the meshes of an annotation.
+
+    The folder is named after a hash of everything the meshes depend on:
+    the annotation volume, the meshed structures and the mesh parameters.
+
+    Returns
+    -------
+        Path: Folder for the meshes of this annotation.
+    """
+    mesh_hash = hashlib.sha256(
+        json.dumps(
+            {
+                "shape": annotated_volume.shape,
+                "dtype": str(annotated_volume.dtype),
+                "structure_ids": sorted(s["id"] for s in structures),
+                "decimate_fraction": MESH_DECIMATE_FRACTION,
+                "closing_n_iters": MESH_CLOSING_N_ITERS,
+                "smooth": MESH_SMOOTH,
+            }
+        ).encode()
+    )
+    mesh_hash.update(np.ascontiguousarray(annotated_volume))
+    return download_dir_path / "mesh_cache" / mesh_hash.hexdigest()
+
+
+def retrieve_or_construct_meshes(
+    mesh_cache_dir, annotated_volume, structures, pool=None
+):
+    """
+    Construct the meshes, reusing any previously built in mesh_cache_dir.
+    The meshes are stored together with the labels present in the
+    annotation. If they are still there, reruns of the script skip mesh
+    construction (see KEEP_MESH_CACHE).
+
+    Returns
+    -------
+        tuple: Dictionary of structure IDs and paths to their .obj mesh
+        files, and the list of labels present in the annotation volume.
+    """
+    mesh_cache_path = mesh_cache_dir / "mesh_cache.json"
+    if mesh_cache_path.exists():
+        with open(mesh_cache_path) as f:
+            mesh_cache = json.load(f)
+        meshes_dict = {
+            int(structure_id): mesh_cache_dir / "meshes" / filename
+            for structure_id, filename in mesh_cache["meshes"].items()
+        }
+        # Rebuild the meshes if any of them has been deleted since
+        if all(path.exists() for path in meshes_dict.values()):
+            return meshes_dict, mesh_cache["labels"]
+        mesh_cache_path.unlink()
+
+    mesh_cache_dir.mkdir(parents=True, exist_ok=True)
+    labels, _ = get_label_counts(annotated_volume)
+    meshes_dict = construct_meshes_from_annotation(
+        mesh_cache_dir,
+        annotated_volume,
+        structures,
+        decimate_fraction=MESH_DECIMATE_FRACTION,
+        closing_n_iters=MESH_CLOSING_N_ITERS,
+        smooth=MESH_SMOOTH,
+        pool=pool,
+        labels=labels,
+    )
+    labels = labels.tolist()
+    # Only written once all meshes exist, so an interrupted run is redone
+    with open(mesh_cache_path, "w") as f:
+        json.dump(
+            {
+                "meshes": {k: v.name for k, v in meshes_dict.items()},
+                "labels": labels,
+            },
+            f,
+        )
+    return meshes_dict, labels
+
 
 if __name__ == "__main__":
     bg_root_dir = Path.home() / "brainglobe_workingdir" / NAME
@@ -211,56 +340,63 @@ if __name__ == "__main__":
         atlas_name=NAME,
         atlas_file_url=data_file_url,
     )
-    for age in range(4, 57):
-        if age != 4:
-            shutil.rmtree(age_specific_root_dir)
-        age_specific_root_dir = bg_root_dir / f"P{age}"
-        age_specific_root_dir.mkdir(exist_ok=True)
-        for resolution, modalities in resolution_to_modalities.items():
-            if resolution != list(resolution_to_modalities.keys())[0]:
-                shutil.rmtree(age_specific_root_dir)
-            age_specific_root_dir.mkdir(exist_ok=True)
-            reference_volume, annotated_volume = (
-                retrieve_reference_and_annotation(
-                    bg_root_dir, age, resolution, modalities[0]
+    structures = retrieve_structure_information(
+        bg_root_dir, list(resolution_to_modalities.keys())[0]
+    )
+    structures = [
+        {k: s[k] for k in TEMPLATE_KEYS if k in s} for s in structures
+    ]
+    # Reuse the same mesh worker processes for every age and resolution,
+    # starting them before any volume is loaded so they stay small
+    with mp.Pool(get_mesh_pool_size(resolution_to_modalities)) as pool:
+        for age in range(4, 57):
+            for resolution, modalities in resolution_to_modalities.items():
+                reference_volume, annotated_volume = (
+                    retrieve_reference_and_annotation(
+                        bg_root_dir, age, resolution, modalities[0]
+                    )
                 )
-            )
-            if len(modalities) > 1:
-                additional_references = retrieve_additional_references(
-                    bg_root_dir, age, resolution, modalities[1:]
+                # Meshing is the step with the highest memory use and doesn't
+                # need the references, so keep them out of memory until then
+                reference_path = bg_root_dir / "reference_volume.npy"
+                np.save(reference_path, reference_volume)
+                del reference_volume
+                gc.collect()
+                hemispheres_stack = retrieve_hemisphere_map()
+                mesh_cache_dir = get_mesh_cache_dir(
+                    bg_root_dir, annotated_volume, structures
                 )
-            hemispheres_stack = retrieve_hemisphere_map()
-            structures = retrieve_structure_information(bg_root_dir)
-            meshes_dict = construct_meshes_from_annotation(
-                age_specific_root_dir,
-                annotated_volume,
-                structures,
-                decimate_fraction=0.5,
-                closing_n_iters=1,
-            )
-            current_name = f"{NAME}_p{age}"
-
-            structures = [
-                {k: s[k] for k in TEMPLATE_KEYS if k in s} for s in structures
-            ]
-            output_filename = wrapup_atlas_from_data(
-                atlas_name=current_name,
-                atlas_minor_version=VERSION,
-                citation=CITATION,
-                atlas_link=ATLAS_LINK,
-                species=SPECIES,
-                resolution=(resolution,) * 3,
-                orientation=ORIENTATION,
-                root_id=ROOT_ID,
-                reference_stack=reference_volume,
-                annotation_stack=annotated_volume,
-                structures_list=structures,
-                meshes_dict=meshes_dict,
-                working_dir=bg_root_dir,
-                hemispheres_stack=None,
-                cleanup_files=False,
-                compress=True,
-                scale_meshes=True,
-                additional_references=additional_references,
-            )
-        meshes_dict = None
+                meshes_dict, annotation_labels = retrieve_or_construct_meshes(
+                    mesh_cache_dir, annotated_volume, structures, pool=pool
+                )
+                reference_volume = np.load(reference_path, mmap_mode="r")
+                if len(modalities) > 1:
+                    additional_references = retrieve_additional_references(
+                        bg_root_dir, age, resolution, modalities[1:]
+                    )
+                current_name = f"{NAME}_p{age}"
+                output_filename = wrapup_atlas_from_data(
+                    atlas_name=current_name,
+                    atlas_minor_version=VERSION,
+                    citation=CITATION,
+                    atlas_link=ATLAS_LINK,
+                    species=SPECIES,
+                    resolution=(resolution,) * 3,
+                    orientation=ORIENTATION,
+                    root_id=ROOT_ID,
+                    reference_stack=reference_volume,
+                    annotation_stack=annotated_volume,
+                    structures_list=structures,
+                    meshes_dict=meshes_dict,
+                    working_dir=bg_root_dir,
+                    hemispheres_stack=None,
+                    cleanup_files=False,
+                    compress=True,
+                    scale_meshes=True,
+                    additional_references=additional_references,
+                    annotation_labels=annotation_labels,
+                )
+                del reference_volume
+                reference_path.unlink()
+                if not KEEP_MESH_CACHE:
+                    shutil.rmtree(mesh_cache_dir)
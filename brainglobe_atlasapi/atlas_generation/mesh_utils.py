@@ -1,10 +1,11 @@
 """Utility functions for working with meshes."""
 
 import shutil
+from contextlib import nullcontext
 
 from brainglobe_utils.general.system import get_num_processes
 from rich.progress import track
-from scipy.ndimage import binary_closing, binary_fill_holes
+from scipy.ndimage import binary_closing, binary_fill_holes, find_objects
 
 from brainglobe_atlasapi.structure_tree_util import (
     get_structures_tree,
@@ -36,6 +37,9 @@ from loguru import logger
 
 from brainglobe_atlasapi.atlas_generation.volume_utils import (
     create_masked_array,
+    get_label_bounding_boxes,
+    get_label_counts,
+    merge_bounding_boxes,
 )
 
 # ----------------- #
@@ -169,11 +173,17 @@ def create_region_mesh(args):
     meshes_dir_path: pathlib Path object with folder where meshes are saved
     tree: treelib.Tree with hierarchical structures information
     node: tree's node corresponding to the region whose mesh is being created
-    labels: list of unique label annotations in annotated volume,
-    (list(np.unique(annotated_volume)))
+    labels: collection of unique label annotations in annotated volume,
+    ideally a set for fast membership tests
+    (set(np.unique(annotated_volume).tolist()))
     annotated_volume: 3d numpy array path to a zarr store with annotations
     ROOT_ID: int,
     id of root structure (mesh creation is a bit more refined for that)
+    bounding_box: tuple of slice, optional (11th argument),
+    bounding box of the region's and its children's labels in
+    annotated_volume (e.g. merged from get_label_bounding_boxes). If given,
+    only that part of the volume is read and masked, rather than the
+    whole volume.
     """
     # Split arguments
     meshes_dir_path = args[0]
@@ -186,6 +196,7 @@ def create_region_mesh(args):
     decimate_fraction = args[7]
     smooth = args[8]
     verbosity = args[9] if len(args) > 9 else 0
+    bounding_box = args[10] if len(args) > 10 else None
 
     if verbosity > 0:
         logger.debug(f"Creating mesh for region {args[1].identifier}")
@@ -206,9 +217,10 @@ def create_region_mesh(args):
                 " or a path to a zarr store"
             )
 
-    # Get labels for region and it's children
-    stree = tree.subtree(node.identifier)
-    ids = list(stree.nodes.keys())
+    # Get labels for region and it's children. Walking the tree is enough,
+    # there's no need to build a subtree (which also adds a set of
+    # pointers to every node in it on each call)
+    ids = list(tree.expand_tree(node.identifier, sorting=False))
 
     # Keep only labels that are in the annotation volume
     matched_labels = [i for i in ids if i in labels]
@@ -219,28 +231,76 @@ def create_region_mesh(args):
         if verbosity > 0:
             print(f"No labels found for {node.tag}")
         return
-    else:
-        # Create mask and extract mesh
-        mask = create_masked_array(annotated_volume, ids)
 
-        if np.sum(mask) == 0:
+    # root mesh is closed more than the other regions
+    if node.identifier == ROOT_ID:
+        closing_n_iters = 8
+
+    if bounding_box is None:
+        # Find the region's bounding box from its mask of the whole volume
+        mask = create_masked_array(annotated_volume, ids)
+        bounding_boxes = find_objects(mask.view(np.uint8))
+        if not bounding_boxes:
             print(f"Empty mask for {node.tag}")
-        else:
-            if node.identifier == ROOT_ID:
-                extract_mesh_from_mask(
-                    mask,
-                    obj_filepath=savepath,
-                    smooth=smooth,
-                    decimate_fraction=decimate_fraction,
-                )
-            else:
-                extract_mesh_from_mask(
-                    mask,
-                    obj_filepath=savepath,
-                    smooth=smooth,
-                    closing_n_iters=closing_n_iters,
-                    decimate_fraction=decimate_fraction,
-                )
+            return
+        mask, offset = crop_to_bounding_box(
+            mask, bounding_boxes[0], padding=closing_n_iters
+        )
+    else:
+        # Only read (and, for a zarr store, decompress) and mask the part
+        # of the volume around the region
+        annotated_volume, offset = crop_to_bounding_box(
+            annotated_volume, bounding_box, padding=closing_n_iters
+        )
+        mask = create_masked_array(np.asarray(annotated_volume), ids)
+
+    mesh = extract_mesh_from_mask(
+        mask,
+        smooth=smooth,
+        closing_n_iters=closing_n_iters,
+        decimate_fraction=decimate_fraction,
+    )
+    # Move the mesh back into the coordinates of the full volume
+    mesh.vertices = mesh.vertices + np.array(offset)
+    write(mesh, str(savepath))
+
+
+def crop_to_bounding_box(mask, bounding_box, padding=None):
+    """
+    Crop a binary mask to a bounding box, leaving a margin of empty voxels.
+
+    Cropping lets meshes of small regions be extracted without processing
+    the whole annotation volume. The margin is one voxel wider than
+    `padding` so that the morphological closing applied by
+    extract_mesh_from_mask, and the extracted surface, are the same as
+    for the uncropped mask. An annotation volume can be cropped the same
+    way before it is masked.
+
+    Parameters
+    ----------
+    mask: np.ndarray or zarr.Array
+        binary mask, or annotation volume
+    bounding_box: tuple of slice
+        bounding box of the non-zero voxels in mask (or of the region
+        in the annotation volume), as returned by
+        scipy.ndimage.find_objects
+    padding: int or None
+        number of closing iterations that will be applied to the mask.
+        None is treated as 0.
+
+    Returns
+    -------
+    np.ndarray
+        the cropped mask (or annotation volume)
+    tuple of int
+        index of the cropped mask's origin in the original mask
+    """
+    margin = (padding or 0) + 1
+    crop = tuple(
+        slice(max(s.start - margin, 0), min(s.stop + margin, size))
+        for s, size in zip(bounding_box, mask.shape)
+    )
+    return mask[crop], tuple(s.start for s in crop)
 
 
 def construct_meshes_from_annotation(
@@ -253,6 +313,8 @@ def construct_meshes_from_annotation(
     parallel: bool = True,
     num_threads: int = -1,
     verbosity: int = 0,
+    pool=None,
+    labels=None,
 ):
     """
     Retrieve or construct atlas region meshes for a given annotation volume.
@@ -287,6 +349,14 @@ def construct_meshes_from_annotation(
         If > 0, uses that many threads.
     verbosity: int
         Level of verbosity for logging. 0 for no output, 1 for basic info.
+    pool: multiprocessing.pool.Pool, optional
+        Process pool to create the meshes with when parallel is True,
+        e.g. to reuse the same worker processes across several atlases.
+        It is left open. If None, a pool with num_threads processes is
+        created and closed again.
+    labels: np.ndarray, optional
+        Unique labels present in volume, if already computed
+        (e.g. with get_label_counts). Computed from volume if None.
 
     Returns
     -------
@@ -300,7 +370,30 @@ def construct_meshes_from_annotation(
     meshes_dir_path.mkdir(exist_ok=True)
 
     tree = get_structures_tree(structures_list)
-    labels = np.unique(volume).astype(np.int32)
+    if labels is None:
+        labels, _ = get_label_counts(volume)
+    labels = np.unique(np.asarray(labels))
+    # Mesh creation is bound by memory bandwidth, so store the labels in
+    # the smallest integer type that holds them all (e.g. uint16 rather
+    # than int64 when all labels are below 65536). Only cast when that
+    # saves bytes, as a cast to a type of the same size is a full copy.
+    if (
+        np.issubdtype(volume.dtype, np.integer)
+        and labels.size > 0
+        and labels.min() >= 0
+    ):
+        labels_dtype = np.min_scalar_type(int(labels.max()))
+        if labels_dtype.itemsize < volume.dtype.itemsize:
+            volume = volume.astype(labels_dtype)
+    # Find where every label is in a single pass over the volume, so that
+    # each region only reads and masks the part of the volume around it
+    label_bounding_boxes = dict(
+        zip(
+            labels.astype(np.int32).tolist(),
+            get_label_bounding_boxes(volume, labels),
+        )
+    )
+    labels = set(label_bounding_boxes)
 
     # Only used for parallel processing
     ann_path = save_path / "temp_annotations.zarr"
@@ -326,6 +419,32 @@ def construct_meshes_from_annotation(
         ann_store.close()
         volume = ann_path
 
+    # The bounding box of a region contains those of its children, and in a
+    # reversed pre-order traversal every child comes before its parent.
+    # Regions with no label in the volume anywhere in their subtree have
+    # no bounding box and no voxels to mesh, so skip them up front rather
+    # than sending them to create_region_mesh.
+    nodes = list(preorder_depth_first_search(tree))
+    subtree_bounding_boxes = {}
+    for node in reversed(nodes):
+        subtree_bounding_boxes[node.identifier] = merge_bounding_boxes(
+            label_bounding_boxes.get(node.identifier),
+            *(
+                subtree_bounding_boxes[child]
+                for child in tree.is_branch(node.identifier)
+            ),
+        )
+    nodes = [
+        node
+        for node in nodes
+        if subtree_bounding_boxes[node.identifier] is not None
+    ]
+    if verbosity > 0:
+        print(
+            f"Skipping {len(subtree_bounding_boxes) - len(nodes)} regions "
+            "with no labels in the annotation"
+        )
+
     root_id = tree.root
     # Create a list of arguments for each region's mesh creation
     args_list = [
@@ -340,24 +459,33 @@ def construct_meshes_from_annotation(
             decimate_fraction,
             smooth,
             verbosity,
+            subtree_bounding_boxes[node.identifier],
         )
-        for node in preorder_depth_first_search(tree)
+        for node in nodes
     ]
 
     if parallel:
-        if num_threads == -1:
-            # Each thread uses ~ 7 times the number of voxels in the volume.
-            mem_per_thread = 7 * volume_size
-            num_threads = get_num_processes(
-                ram_needed_per_process=mem_per_thread,
-                n_max_processes=mp.cpu_count() - 1,
-                fraction_free_ram=0.05,
-            )
-            logger.info(f"Using {num_threads} threads for mesh creation")
+        if pool is None:
+            if num_threads == -1:
+                # Each thread uses ~ 7 times the number of voxels in the
+                # volume.
+                mem_per_thread = 7 * volume_size
+                num_threads = get_num_processes(
+                    ram_needed_per_process=mem_per_thread,
+                    n_max_processes=mp.cpu_count() - 1,
+                    fraction_free_ram=0.05,
+                )
+                logger.info(f"Using {num_threads} threads for mesh creation")
+            pool_context = mp.Pool(num_threads)
+        else:
+            # Leave a pool passed in by the caller open, so it can be reused
+            pool_context = nullcontext(pool)
 
-        with mp.Pool(num_threads) as pool:
+        # Each region writes its own .obj file, so completion order is
+        # irrelevant and workers can pick up the next region straight away
+        with pool_context as mesh_pool:
             for _ in track(
-                pool.imap(create_region_mesh, args_list),
+                mesh_pool.imap_unordered(create_region_mesh, args_list),
                 total=len(args_list),
                 description="Creating meshes",
             ):
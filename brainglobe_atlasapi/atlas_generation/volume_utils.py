@@ -6,6 +6,7 @@ extracting surfaces from volumetric data ....
 
 import numpy as np
 import zarr
+from scipy.ndimage import find_objects
 
 
 def create_masked_array(volume, label, greater_than=False):
@@ -55,3 +56,134 @@ def create_masked_array(volume, label, greater_than=False):
         mask = volume > label
 
     return mask
+
+
+def get_label_counts(volume, max_bincount_label=2**24, max_slab_voxels=2**22):
+    """Count the voxels of each label present in a volume.
+
+    For non-negative integer volumes whose largest label is below
+    `max_bincount_label` the counts are accumulated with `np.bincount`,
+    which avoids sorting the whole volume as `np.unique` does.
+    `np.bincount` converts its input to 8 byte integers, so it is applied
+    to slabs along the first axis to bound that temporary copy. Other
+    volumes, e.g. with large structure IDs, fall back to `np.unique`.
+
+    The range of the labels is only scanned for when the dtype can hold
+    labels outside of the `np.bincount` range (e.g. not for uint8 and
+    uint16), which costs one pass for the largest label and, for signed
+    dtypes, one for the smallest.
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        The input annotation volume.
+    max_bincount_label : int, optional
+        Largest label (exclusive) for which `np.bincount` is used, as it
+        allocates one counter per possible label. By default, 2**24.
+    max_slab_voxels : int, optional
+        Largest number of voxels passed to `np.bincount` at once.
+        By default, 2**22 (a 32 MB temporary copy).
+
+    Returns
+    -------
+    np.ndarray
+        The sorted unique labels present in `volume`.
+    np.ndarray
+        The number of voxels of each label.
+    """
+    if np.issubdtype(volume.dtype, np.integer) and volume.size > 0:
+        max_label = int(np.iinfo(volume.dtype).max)
+        if max_label >= max_bincount_label:
+            max_label = int(volume.max())
+        if max_label < max_bincount_label and (
+            np.issubdtype(volume.dtype, np.unsignedinteger)
+            or volume.min() >= 0
+        ):
+            counts = np.zeros(max_label + 1, dtype=np.intp)
+            voxels_per_slice = volume.size // volume.shape[0]
+            slab_size = max(1, max_slab_voxels // max(voxels_per_slice, 1))
+            for start in range(0, volume.shape[0], slab_size):
+                slab = volume[start : start + slab_size]
+                counts += np.bincount(slab.ravel(), minlength=max_label + 1)
+            labels = np.flatnonzero(counts)
+            return labels.astype(volume.dtype), counts[labels]
+
+    return np.unique(volume, return_counts=True)
+
+
+def get_label_bounding_boxes(volume, labels, max_slab_voxels=2**22):
+    """Find the bounding box of each label with a single pass over a volume.
+
+    `scipy.ndimage.find_objects` needs labels numbered from 1, so each
+    slab along the first axis is remapped to the index of its labels in
+    `labels` first. This finds all bounding boxes at once, however large
+    the label values (e.g. Allen structure IDs up to ~6e8), instead of
+    scanning the whole volume once per label.
+
+    Parameters
+    ----------
+    volume : np.ndarray or zarr.Array
+        The input annotation volume.
+    labels : np.ndarray
+        Sorted labels to find the bounding boxes of, e.g. as returned by
+        `get_label_counts`. Voxels with other values are ignored.
+    max_slab_voxels : int, optional
+        Largest number of voxels remapped at once.
+        By default, 2**22.
+
+    Returns
+    -------
+    list of (tuple of slice or None)
+        The bounding box of each label in `labels`, as returned by
+        `scipy.ndimage.find_objects`, or None if it isn't in `volume`.
+    """
+    labels = np.asarray(labels)
+    bounding_boxes = [None] * labels.size
+    if volume.size == 0 or labels.size == 0:
+        return bounding_boxes
+
+    voxels_per_slice = volume.size // volume.shape[0]
+    slab_size = max(1, max_slab_voxels // max(voxels_per_slice, 1))
+    for start in range(0, volume.shape[0], slab_size):
+        slab = np.asarray(volume[start : start + slab_size])
+        indices = np.minimum(np.searchsorted(labels, slab), labels.size - 1)
+        # find_objects ignores 0, so it marks values that aren't labels
+        indices = np.where(labels[indices] == slab, indices + 1, 0)
+        slab_bounding_boxes = find_objects(indices, max_label=labels.size)
+        for i, bounding_box in enumerate(slab_bounding_boxes):
+            if bounding_box is not None:
+                # Move the bounding box into the coordinates of the volume
+                bounding_box = (
+                    slice(
+                        bounding_box[0].start + start,
+                        bounding_box[0].stop + start,
+                    ),
+                    *bounding_box[1:],
+                )
+                bounding_boxes[i] = merge_bounding_boxes(
+                    bounding_boxes[i], bounding_box
+                )
+    return bounding_boxes
+
+
+def merge_bounding_boxes(*bounding_boxes):
+    """Find the smallest bounding box containing all the given ones.
+
+    Parameters
+    ----------
+    *bounding_boxes : tuple of slice or None
+        Bounding boxes as returned by `scipy.ndimage.find_objects`.
+        None (no bounding box) is ignored.
+
+    Returns
+    -------
+    tuple of slice or None
+        The merged bounding box, or None if all bounding boxes are None.
+    """
+    bounding_boxes = [bb for bb in bounding_boxes if bb is not None]
+    if not bounding_boxes:
+        return None
+    return tuple(
+        slice(min(s.start for s in axis), max(s.stop for s in axis))
+        for axis in zip(*bounding_boxes)
+    )
@@ -28,6 +28,9 @@ from brainglobe_atlasapi.atlas_generation.structures import (
 from brainglobe_atlasapi.atlas_generation.validate_atlases import (
     get_all_validation_functions,
 )
+from brainglobe_atlasapi.atlas_generation.volume_utils import (
+    get_label_counts,
+)
 from brainglobe_atlasapi.structure_tree_util import get_structures_tree
 from brainglobe_atlasapi.utils import atlas_name_from_repr
 
@@ -36,7 +39,9 @@ from brainglobe_atlasapi.utils import atlas_name_from_repr
 ATLAS_VERSION = brainglobe_atlasapi.atlas_generation.__version__
 
 
-def filter_structures_not_present_in_annotation(structures, annotation):
+def filter_structures_not_present_in_annotation(
+    structures, annotation, present_ids=None
+):
     """
     Filter out structures not present in the annotation volume.
 
@@ -52,6 +57,9 @@ def filter_structures_not_present_in_annotation(structures, annotation):
     annotation : np.ndarray
         The annotation volume (3D NumPy array) where each voxel contains
         a structure ID.
+    present_ids : iterable of int, optional
+        The labels present in `annotation`, if already known (e.g. from
+        `get_label_counts`). Avoids scanning the annotation volume again.
 
     Returns
     -------
@@ -59,7 +67,9 @@ def filter_structures_not_present_in_annotation(structures, annotation):
         A new list containing only the structure dictionaries that are
         present in the annotation volume or have descendants present.
     """
-    present_ids = set(np.unique(annotation))
+    if present_ids is None:
+        present_ids, _ = get_label_counts(annotation)
+    present_ids = set(np.asarray(present_ids).tolist())
     # Create a structure tree for easy parent-child relationship traversal
     tree = get_structures_tree(structures)
 
@@ -73,11 +83,14 @@ def filter_structures_not_present_in_annotation(structures, annotation):
                 return True
         return False
 
-    removed = [s for s in structures if not is_present(s["id"])]
-    for r in removed:
-        print("Removed structure:", r["name"], "(ID:", r["id"], ")")
+    present = []
+    for s in structures:
+        if is_present(s["id"]):
+            present.append(s)
+        else:
+            print("Removed structure:", s["name"], "(ID:", s["id"], ")")
 
-    return [s for s in structures if is_present(s["id"])]
+    return present
 
 
 def wrapup_atlas_from_data(
@@ -102,6 +115,7 @@ def wrapup_atlas_from_data(
     resolution_mapping=None,
     additional_references={},
     additional_metadata={},
+    annotation_labels=None,
 ):
     """
     Finalise an atlas with truly consistent format from all the data.
@@ -163,13 +177,17 @@ def wrapup_atlas_from_data(
     additional_metadata: dict, optional
         (Default value = empty dict).
         Additional metadata to write to metadata.json
+    annotation_labels: array-like, optional
+        (Default value = None).
+        Labels present in the annotation stack, if already computed
+        (e.g. for mesh construction), to avoid scanning the stack again.
     """
     # If no hemisphere file is given, assume the atlas is symmetric:
     symmetric = hemispheres_stack is None
     if isinstance(annotation_stack, str) or isinstance(annotation_stack, Path):
         annotation_stack = tifffile.imread(annotation_stack)
     structures_list = filter_structures_not_present_in_annotation(
-        structures_list, annotation_stack
+        structures_list, annotation_stack, present_ids=annotation_labels
     )
 
     # Instantiate BGSpace obj, using original stack size in um as meshes
@@ -0,0 +1,342 @@
+"""Tests for downloading and extracting the CCFv3a atlas archive."""
+
+import json
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+import requests
+
+pytest.importorskip("nrrd")
+
+from atlas_scripts.allen_bbp_ccfv3a_entire_mouse_brain import (  # noqa: E402
+    download_in_ranges,
+    download_resources,
+    extract_zip_in_parallel,
+    get_range_progress_path,
+    get_ranged_download_size,
+    stream_response_to_file,
+)
+
+CONTENT = bytes(range(256)) * 400
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    """Serve `server.content`, optionally with byte ranges and failures.
+
+    Each GET request takes the next entry of `server.failures`, if any:
+    an HTTP status code to answer with, or "drop" to close the connection
+    halfway through the body.
+    """
+
+    def log_message(self, format, *args):
+        """Keep the test output quiet."""
+
+    def send_content_headers(self, status, length):
+        """Send the headers of a response with a body of `length` bytes."""
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        if self.server.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_HEAD(self):
+        """Answer with the size of the content or `server.head_status`."""
+        if self.server.head_status != 200:
+            self.send_error(self.server.head_status)
+            return
+        self.send_content_headers(200, len(self.server.content))
+
+    def do_GET(self):
+        """Answer with (a range of) the content, or with a failure."""
+        content = self.server.content
+        byte_range = self.headers.get("Range")
+        with self.server.lock:
+            self.server.requested_ranges.append(byte_range)
+            failure = (
+                self.server.failures.pop(0) if self.server.failures else None
+            )
+        if isinstance(failure, int):
+            self.send_error(failure)
+            return
+
+        status = 200
+        if byte_range and self.server.accept_ranges:
+            start, end = map(int, byte_range[len("bytes=") :].split("-"))
+            content = content[start : end + 1]
+            status = 206
+        self.send_content_headers(status, len(content))
+        if failure == "drop":
+            self.wfile.write(content[: len(content) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def file_server():
+    """Serve `CONTENT` from a local HTTP server supporting byte ranges."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FileRequestHandler)
+    server.content = CONTENT
+    server.accept_ranges = True
+    server.head_status = 200
+    server.failures = []
+    server.requested_ranges = []
+    server.lock = threading.Lock()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/archive.zip"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_ranged_download_size(file_server):
+    """Test the size is returned when the server accepts ranges."""
+    assert get_ranged_download_size(file_server.url) == len(CONTENT)
+
+
+@pytest.mark.parametrize(
+    "accept_ranges, head_status",
+    [
+        pytest.param(False, 200, id="no ranges"),
+        pytest.param(True, 405, id="HEAD not allowed"),
+        pytest.param(True, 403, id="HEAD forbidden"),
+    ],
+)
+def test_get_ranged_download_size_unsupported(
+    file_server, accept_ranges, head_status
+):
+    """Test None is returned when a ranged download isn't possible.
+
+    Parameters
+    ----------
+    file_server : ThreadingHTTPServer
+        Local server provided by the fixture.
+    accept_ranges : bool
+        Whether the server advertises byte range support.
+    head_status : int
+        Status the server answers HEAD requests with.
+    """
+    file_server.accept_ranges = accept_ranges
+    file_server.head_status = head_status
+    assert get_ranged_download_size(file_server.url) is None
+
+
+def test_get_ranged_download_size_unreachable(file_server):
+    """Test None is returned when the server can't be reached."""
+    url = file_server.url
+    file_server.shutdown()
+    file_server.server_close()
+    assert get_ranged_download_size(url) is None
+
+
+def test_download_in_ranges(file_server, tmp_path):
+    """Test the file is split into one range request per connection."""
+    file_path = tmp_path / "archive.zip.part"
+
+    download_in_ranges(
+        file_server.url,
+        file_path,
+        len(CONTENT),
+        n_connections=3,
+        chunk_size=1000,
+    )
+
+    assert file_path.read_bytes() == CONTENT
+    assert sorted(file_server.requested_ranges) == [
+        "bytes=0-34133",
+        "bytes=34134-68267",
+        "bytes=68268-102399",
+    ]
+    assert not get_range_progress_path(file_path).exists()
+
+
+def test_download_in_ranges_ignored_range(file_server, tmp_path):
+    """Test a server answering 200 to range requests raises ValueError."""
+    file_server.accept_ranges = False
+    file_path = tmp_path / "archive.zip.part"
+
+    with pytest.raises(ValueError, match="Range requests not supported"):
+        download_in_ranges(
+            file_server.url, file_path, len(CONTENT), n_connections=2
+        )
+
+    assert not get_range_progress_path(file_path).exists()
+
+
+@pytest.mark.parametrize(
+    "failures, expected_pauses",
+    [
+        pytest.param(["drop"], [0.5], id="dropped connection"),
+        # the pause is reset once the dropped connection has received data
+        pytest.param(
+            [429, 503, "drop", 500], [0.5, 1, 0.5, 1], id="throttled"
+        ),
+    ],
+)
+def test_download_in_ranges_retries(
+    file_server, tmp_path, failures, expected_pauses
+):
+    """Test ranges are resumed after an exponentially increasing pause.
+
+    Parameters
+    ----------
+    file_server : ThreadingHTTPServer
+        Local server provided by the fixture.
+    tmp_path : Path
+        Temporary directory path provided by pytest fixture.
+    failures : list
+        Failures of the first requests to the server.
+    expected_pauses : list of float
+        Expected pauses in seconds before each retry.
+    """
+    file_server.failures = list(failures)
+    file_path = tmp_path / "archive.zip.part"
+
+    with patch("time.sleep") as mock_sleep:
+        download_in_ranges(
+            file_server.url,
+            file_path,
+            len(CONTENT),
+            n_connections=1,
+            chunk_size=1000,
+            backoff_factor=0.5,
+        )
+
+    assert file_path.read_bytes() == CONTENT
+    assert [
+        call.args[0] for call in mock_sleep.call_args_list
+    ] == expected_pauses
+    # the dropped connection is resumed after the bytes already written
+    resumed_start = int(file_server.requested_ranges[-1][6:].split("-")[0])
+    assert 0 < resumed_start < len(CONTENT)
+
+
+def test_download_in_ranges_gives_up(file_server, tmp_path):
+    """Test a range failing `max_retries` times in a row is given up on."""
+    file_server.failures = [503] * 3
+    file_path = tmp_path / "archive.zip.part"
+
+    with patch("time.sleep"), pytest.raises(requests.ConnectionError):
+        download_in_ranges(
+            file_server.url,
+            file_path,
+            len(CONTENT),
+            n_connections=1,
+            max_retries=2,
+        )
+
+    # kept so that the next run can continue the download
+    assert get_range_progress_path(file_path).exists()
+
+
+def test_download_in_ranges_client_error(file_server, tmp_path):
+    """Test errors that won't go away by waiting are not retried."""
+    file_server.failures = [404]
+
+    with patch("time.sleep") as mock_sleep, pytest.raises(requests.HTTPError):
+        download_in_ranges(
+            file_server.url,
+            tmp_path / "archive.zip.part",
+            len(CONTENT),
+            n_connections=1,
+        )
+
+    mock_sleep.assert_not_called()
+
+
+def test_download_in_ranges_continues_previous_run(file_server, tmp_path):
+    """Test a download interrupted in an earlier run is not restarted."""
+    file_path = tmp_path / "archive.zip.part"
+    file_path.write_bytes(CONTENT[:1000] + bytes(len(CONTENT) - 1000))
+    with open(get_range_progress_path(file_path), "w") as f:
+        json.dump(
+            {"total_size": len(CONTENT), "ranges": [[1000, len(CONTENT) - 1]]},
+            f,
+        )
+
+    download_in_ranges(file_server.url, file_path, len(CONTENT))
+
+    assert file_path.read_bytes() == CONTENT
+    assert file_server.requested_ranges == [f"bytes=1000-{len(CONTENT) - 1}"]
+    assert not get_range_progress_path(file_path).exists()
+
+
+class MockResponse:
+    """Minimal streamed response yielding the content in chunks."""
+
+    headers = {"content-length": str(len(CONTENT))}
+
+    def iter_content(self, chunk_size):
+        """Yield the content in chunks of `chunk_size` bytes."""
+        for start in range(0, len(CONTENT), chunk_size):
+            yield CONTENT[start : start + chunk_size]
+
+
+def test_stream_response_to_file(tmp_path):
+    """Test a streamed response is written to disk."""
+    file_path = tmp_path / "archive.zip.part"
+    stream_response_to_file(MockResponse(), file_path, chunk_size=1000)
+    assert file_path.read_bytes() == CONTENT
+
+
+def test_stream_response_to_file_write_error(tmp_path):
+    """Test errors of the writer thread are raised.
+
+    The response has more chunks than fit in the queue to the writer
+    thread, so this also checks the reading side doesn't block.
+    """
+    with pytest.raises(FileNotFoundError):
+        stream_response_to_file(
+            MockResponse(),
+            tmp_path / "missing" / "archive.zip.part",
+            chunk_size=100,
+        )
+
+
+def test_download_resources_without_ranges(file_server, tmp_path):
+    """Test the archive is downloaded in one go when HEAD is rejected."""
+    archive_path = tmp_path / "served.zip"
+    with zipfile.ZipFile(archive_path, "w") as zip_ref:
+        zip_ref.writestr("nissl_average_full.nii.gz", CONTENT)
+        zip_ref.writestr("annotations/annotation_25.nrrd", CONTENT[::-1])
+    file_server.content = archive_path.read_bytes()
+    file_server.head_status = 405
+    download_dir_path = tmp_path / "download"
+    download_dir_path.mkdir()
+
+    download_resources(download_dir_path, file_server.url, "atlas")
+
+    assert file_server.requested_ranges == [None]
+    assert (download_dir_path / "atlas-files-archive.zip").exists()
+    assert (
+        download_dir_path / "annotations" / "annotation_25.nrrd"
+    ).read_bytes() == CONTENT[::-1]
+
+
+def test_extract_zip_in_parallel(tmp_path):
+    """Test members are extracted where `extractall` would put them."""
+    archive_path = tmp_path / "archive.zip"
+    with zipfile.ZipFile(archive_path, "w") as zip_ref:
+        for name in ["a.nrrd", "dir/b.nrrd", "../c.nrrd", "/abs/d.nrrd"]:
+            zip_ref.writestr(name, name * 100)
+
+    with zipfile.ZipFile(archive_path) as zip_ref:
+        zip_ref.extractall(tmp_path / "expected")
+    extract_zip_in_parallel(archive_path, tmp_path / "extracted", 2)
+
+    expected = {
+        path.relative_to(tmp_path / "expected"): path.read_bytes()
+        for path in (tmp_path / "expected").rglob("*")
+        if path.is_file()
+    }
+    extracted = {
+        path.relative_to(tmp_path / "extracted"): path.read_bytes()
+        for path in (tmp_path / "extracted").rglob("*")
+        if path.is_file()
+    }
+    assert extracted == expected
+    assert not (tmp_path / "c.nrrd").exists()
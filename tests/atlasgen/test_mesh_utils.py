@@ -1,16 +1,20 @@
 """Tests for mesh utility functions."""
 
+import multiprocessing as mp
 from pathlib import Path
 from unittest.mock import patch
 
 import numpy as np
 import pytest
 import zarr
+from scipy.ndimage import find_objects
+from vedo import load
 
 from brainglobe_atlasapi.atlas_generation.mesh_utils import (
     Region,
     construct_meshes_from_annotation,
     create_region_mesh,
+    crop_to_bounding_box,
     extract_mesh_from_mask,
 )
 from brainglobe_atlasapi.structure_tree_util import get_structures_tree
@@ -186,6 +190,114 @@ def test_create_region_mesh(region_mesh_args):
     assert mesh_files[0].suffix == ".obj"
 
 
+@pytest.mark.parametrize(
+    "region_mesh_args",
+    [
+        pytest.param(5),
+        pytest.param(999, id="root_id (999)"),
+    ],
+    indirect=True,
+)
+def test_create_region_mesh_cropped_coordinates(region_mesh_args):
+    """Test meshes of cropped masks are placed in full volume coordinates.
+
+    Parameters
+    ----------
+    region_mesh_args : tuple
+        Arguments for `create_region_mesh` provided by the fixture.
+    """
+    args = list(region_mesh_args)
+    args[8] = False  # smoothing would shrink the mesh bounds
+    create_region_mesh(tuple(args))
+    node, tree, annotated_volume = args[1], args[2], args[4]
+
+    ids = list(tree.subtree(node.identifier).nodes.keys())
+    mask = np.isin(annotated_volume, ids)
+    mesh = load(str(args[0] / f"{node.identifier}.obj"))
+    expected_bounds = [
+        bound
+        for s in find_objects(mask.view(np.uint8))[0]
+        for bound in (s.start - 0.5, s.stop - 0.5)
+    ]
+    assert np.allclose(mesh.bounds(), expected_bounds, atol=1)
+
+
+@pytest.mark.parametrize(
+    "region_mesh_args",
+    [
+        pytest.param(5),
+        pytest.param(101, id="parent region"),
+        pytest.param(999, id="root_id (999)"),
+    ],
+    indirect=True,
+)
+@pytest.mark.parametrize("use_zarr", [False, True])
+def test_create_region_mesh_bounding_box(region_mesh_args, tmp_path, use_zarr):
+    """Test meshes from a precomputed bounding box match those without.
+
+    Parameters
+    ----------
+    region_mesh_args : tuple
+        Arguments for `create_region_mesh` provided by the fixture.
+    tmp_path : Path
+        Temporary directory path provided by pytest fixture.
+    use_zarr : bool
+        Whether the annotation volume is passed as a path to a zarr store.
+    """
+    args = list(region_mesh_args)
+    node, tree, annotated_volume = args[1], args[2], args[4]
+    ids = list(tree.expand_tree(node.identifier))
+    bounding_box = find_objects(np.isin(annotated_volume, ids).view(np.uint8))[
+        0
+    ]
+
+    args[0] = tmp_path / "without_bounding_box"
+    args[0].mkdir()
+    create_region_mesh(tuple(args))
+    if use_zarr:
+        zarr.create_array(tmp_path / "test.zarr", data=annotated_volume)
+        args[4] = tmp_path / "test.zarr"
+    args[0] = tmp_path / "with_bounding_box"
+    args[0].mkdir()
+    create_region_mesh((*args, bounding_box))
+
+    mesh_filename = f"{node.identifier}.obj"
+    assert np.array_equal(
+        load(str(tmp_path / "with_bounding_box" / mesh_filename)).vertices,
+        load(str(tmp_path / "without_bounding_box" / mesh_filename)).vertices,
+    )
+
+
+@pytest.mark.parametrize(
+    "padding, expected_crop",
+    [
+        pytest.param(None, (slice(3, 8), slice(4, 9)), id="no padding"),
+        pytest.param(2, (slice(1, 10), slice(2, 11)), id="padding"),
+        pytest.param(5, (slice(0, 12), slice(0, 12)), id="clipped padding"),
+    ],
+)
+def test_crop_to_bounding_box(padding, expected_crop):
+    """Test cropping a mask to its bounding box with a margin.
+
+    Parameters
+    ----------
+    padding : int or None
+        Number of closing iterations the margin has to accommodate.
+    expected_crop : tuple of slice
+        Expected crop of the original mask.
+    """
+    mask = np.zeros((12, 12), dtype=bool)
+    mask[4:7, 5:8] = True
+
+    cropped, offset = crop_to_bounding_box(
+        mask, find_objects(mask.view(np.uint8))[0], padding=padding
+    )
+
+    assert offset == tuple(s.start for s in expected_crop)
+    assert np.array_equal(cropped, mask[expected_crop])
+    assert cropped.sum() == mask.sum()
+
+
 @pytest.fixture
 def mesh_from_mask():
     """Fixture with volume and default parameters for `mesh_from_mask`.
@@ -405,3 +517,114 @@ def test_construct_meshes_from_annotation(structures, tmp_path, parallel):
     for struct in structures:
         mesh_path = meshes_dir_path / "meshes" / f"{struct['id']}.obj"
         assert mesh_path.exists()
+
+
+@pytest.mark.parametrize(
+    "dtype, expected_dtype",
+    [
+        pytest.param(np.int64, np.uint8, id="int64"),
+        pytest.param(np.uint32, np.uint8, id="uint32"),
+        pytest.param(np.float64, np.float64, id="float64"),
+    ],
+)
+def test_construct_meshes_from_annotation_downcast(
+    structures, tmp_path, dtype, expected_dtype
+):
+    """Test integer annotations are meshed in the smallest sufficient dtype.
+
+    Parameters
+    ----------
+    structures : list of dict
+        Structures provided by the fixture.
+    tmp_path : Path
+        Temporary directory path provided by pytest fixture.
+    dtype : np.dtype
+        Data type of the annotation volume.
+    expected_dtype : np.dtype
+        Data type of the volume passed to `create_region_mesh`.
+    """
+    smoothed_annotations = np.load(
+        Path(__file__).parent / "dummy_data" / "smoothed_annotations.npy"
+    ).astype(dtype)
+
+    with patch(
+        "brainglobe_atlasapi.atlas_generation.mesh_utils.create_region_mesh"
+    ) as mock_create_region_mesh:
+        construct_meshes_from_annotation(
+            tmp_path, smoothed_annotations, structures, parallel=False
+        )
+
+    for call in mock_create_region_mesh.call_args_list:
+        volume = call.args[0][4]
+        assert volume.dtype == expected_dtype
+        assert np.array_equal(volume, smoothed_annotations)
+
+
+def test_construct_meshes_from_annotation_no_downcast_copy(
+    structures, tmp_path
+):
+    """Test annotations are not copied when no smaller dtype fits.
+
+    Allen structure ids go up to ~6e8, which need 4 bytes whether signed
+    or unsigned, so an int32 annotation is meshed as is.
+    """
+    annotation = np.zeros((10, 10, 10), dtype=np.int32)
+    annotation[3:7, 3:7, 3:7] = 5
+    annotation[5, 5, 5] = 614454277
+
+    with patch(
+        "brainglobe_atlasapi.atlas_generation.mesh_utils.create_region_mesh"
+    ) as mock_create_region_mesh:
+        construct_meshes_from_annotation(
+            tmp_path, annotation, structures, parallel=False
+        )
+
+    assert mock_create_region_mesh.call_args_list
+    for call in mock_create_region_mesh.call_args_list:
+        assert call.args[0][4] is annotation
+
+
+def test_construct_meshes_from_annotation_skips_empty_subtrees(
+    structures, tmp_path
+):
+    """Test regions with no labels in their subtree are not meshed.
+
+    Only "aon" (5) is annotated, so "on" (1) is skipped while its
+    ancestors are still meshed.
+    """
+    annotation = np.zeros((10, 10, 10), dtype=np.uint16)
+    annotation[3:7, 3:7, 3:7] = 5
+
+    with patch(
+        "brainglobe_atlasapi.atlas_generation.mesh_utils.create_region_mesh"
+    ) as mock_create_region_mesh:
+        construct_meshes_from_annotation(
+            tmp_path, annotation, structures, parallel=False
+        )
+
+    meshed_ids = [
+        call.args[0][1].identifier
+        for call in mock_create_region_mesh.call_args_list
+    ]
+    assert meshed_ids == [999, 101, 5]
+    # each region is only read around the voxels of its subtree
+    for call in mock_create_region_mesh.call_args_list:
+        assert call.args[0][10] == (slice(3, 7),) * 3
+
+
+def test_construct_meshes_from_annotation_with_pool(structures, tmp_path):
+    """Test constructing meshes with a pool that is reused afterwards."""
+    smoothed_annotations = np.load(
+        Path(__file__).parent / "dummy_data" / "smoothed_annotations.npy"
+    )
+
+    with mp.Pool(2) as pool:
+        for save_path in (tmp_path / "first", tmp_path / "second"):
+            save_path.mkdir()
+            mesh_dict = construct_meshes_from_annotation(
+                save_path, smoothed_annotations, structures, pool=pool
+            )
+
+            assert len(mesh_dict) == len(structures)
+            for struct in structures:
+                assert mesh_dict[struct["id"]].exists()
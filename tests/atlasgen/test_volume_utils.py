@@ -0,0 +1,139 @@
+"""Tests for volume utility functions."""
+
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from scipy.ndimage import find_objects
+
+from brainglobe_atlasapi.atlas_generation.volume_utils import (
+    get_label_bounding_boxes,
+    get_label_counts,
+    merge_bounding_boxes,
+)
+
+
+@pytest.mark.parametrize(
+    "dtype, offset, uses_bincount",
+    [
+        pytest.param(np.uint8, 0, True, id="uint8"),
+        pytest.param(np.uint16, 0, True, id="uint16"),
+        pytest.param(np.int16, 0, True, id="int16"),
+        pytest.param(np.int16, -5, False, id="negative int16 labels"),
+        pytest.param(np.uint32, 0, True, id="uint32"),
+        pytest.param(np.int32, 0, True, id="int32"),
+        pytest.param(np.uint64, 0, True, id="uint64"),
+        pytest.param(np.int32, -5, False, id="negative labels"),
+        pytest.param(np.int64, 614454277, False, id="large labels"),
+        pytest.param(np.float64, 0, False, id="float"),
+    ],
+)
+def test_get_label_counts(dtype, offset, uses_bincount):
+    """Test label counts match `np.unique` on bincount and fallback paths.
+
+    Parameters
+    ----------
+    dtype : np.dtype
+        Data type of the annotation volume.
+    offset : int
+        Value added to the labels, to exercise negative and large labels.
+    uses_bincount : bool
+        Whether the labels are counted with `np.bincount`.
+    """
+    rng = np.random.default_rng(seed=0)
+    volume = (rng.integers(0, 20, size=(10, 12, 14)) + offset).astype(dtype)
+    volume[volume == 3 + offset] = offset  # make sure a label is missing
+
+    with patch.object(np, "unique", wraps=np.unique) as mock_unique:
+        labels, counts = get_label_counts(volume)
+    expected_labels, expected_counts = np.unique(volume, return_counts=True)
+
+    assert mock_unique.called != uses_bincount
+    assert labels.dtype == volume.dtype
+    assert np.array_equal(labels, expected_labels)
+    assert np.array_equal(counts, expected_counts)
+
+
+def test_get_label_counts_empty():
+    """Test that an empty volume has no labels."""
+    labels, counts = get_label_counts(np.zeros((0, 3, 3), dtype=np.uint16))
+    assert labels.size == 0
+    assert counts.size == 0
+
+
+@pytest.mark.parametrize(
+    "max_slab_voxels",
+    [
+        pytest.param(1, id="one slice per slab"),
+        pytest.param(12 * 14 * 3, id="uneven slabs"),
+        pytest.param(2**22, id="single slab"),
+    ],
+)
+def test_get_label_counts_slabs(max_slab_voxels):
+    """Test bincount slabs add up to the counts of the whole volume.
+
+    Parameters
+    ----------
+    max_slab_voxels : int
+        Largest number of voxels counted at once.
+    """
+    rng = np.random.default_rng(seed=0)
+    volume = rng.integers(0, 1000, size=(10, 12, 14)).astype(np.uint16)
+
+    labels, counts = get_label_counts(volume, max_slab_voxels=max_slab_voxels)
+    expected_labels, expected_counts = np.unique(volume, return_counts=True)
+
+    assert np.array_equal(labels, expected_labels)
+    assert np.array_equal(counts, expected_counts)
+
+
+@pytest.mark.parametrize(
+    "max_slab_voxels",
+    [
+        pytest.param(1, id="one slice per slab"),
+        pytest.param(12 * 14 * 3, id="uneven slabs"),
+        pytest.param(2**22, id="single slab"),
+    ],
+)
+def test_get_label_bounding_boxes(max_slab_voxels):
+    """Test bounding boxes match `find_objects` on each label's mask.
+
+    Parameters
+    ----------
+    max_slab_voxels : int
+        Largest number of voxels remapped at once.
+    """
+    volume = np.zeros((10, 12, 14), dtype=np.int64)
+    volume[1:4, 2:5, 3:6] = 614454277
+    volume[2:9, 0:3, 10:14] = 5
+    volume[7, 11, 0] = 614454277
+    labels = np.array([0, 5, 7, 614454277])  # 7 is missing
+
+    bounding_boxes = get_label_bounding_boxes(
+        volume, labels, max_slab_voxels=max_slab_voxels
+    )
+
+    expected_bounding_boxes = [
+        next(iter(find_objects((volume == label).view(np.uint8))), None)
+        for label in labels
+    ]
+    assert bounding_boxes == expected_bounding_boxes
+
+
+def test_get_label_bounding_boxes_ignores_other_values():
+    """Test voxels whose value isn't in the labels are ignored."""
+    volume = np.zeros((4, 4, 4), dtype=np.uint16)
+    volume[1, 1, 1] = 3
+    volume[2:4, 2:4, 2:4] = 9
+
+    bounding_boxes = get_label_bounding_boxes(volume, np.array([3]))
+
+    assert bounding_boxes == [(slice(1, 2), slice(1, 2), slice(1, 2))]
+
+
+def test_merge_bounding_boxes():
+    """Test the merged bounding box contains all the given ones."""
+    assert merge_bounding_boxes(
+        (slice(1, 3), slice(5, 6)), None, (slice(2, 8), slice(0, 4))
+    ) == (slice(1, 8), slice(0, 6))
+    assert merge_bounding_boxes(None, None) is None
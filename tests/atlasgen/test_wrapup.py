@@ -0,0 +1,62 @@
+"""Tests for atlas wrapup functions."""
+
+import numpy as np
+import pytest
+
+from brainglobe_atlasapi.atlas_generation.wrapup import (
+    filter_structures_not_present_in_annotation,
+)
+
+
+@pytest.fixture
+def structures():
+    """Return a small structure hierarchy with one unannotated region."""
+    return [
+        {"id": 1, "acronym": "root", "name": "root", "structure_id_path": [1]},
+        {
+            "id": 2,
+            "acronym": "P",
+            "name": "parent",
+            "structure_id_path": [1, 2],
+        },
+        {
+            "id": 3,
+            "acronym": "C",
+            "name": "child",
+            "structure_id_path": [1, 2, 3],
+        },
+        {
+            "id": 4,
+            "acronym": "A",
+            "name": "absent",
+            "structure_id_path": [1, 4],
+        },
+    ]
+
+
+@pytest.mark.parametrize(
+    "present_ids",
+    [
+        pytest.param(None, id="computed"),
+        pytest.param(np.array([3], dtype=np.uint16), id="array"),
+        pytest.param([0, 3], id="list"),
+    ],
+)
+def test_filter_structures_not_present_in_annotation(structures, present_ids):
+    """Test structures are kept only if they or a descendant are annotated.
+
+    Parameters
+    ----------
+    structures : list of dict
+        Structure hierarchy fixture.
+    present_ids : array-like or None
+        Precomputed labels present in the annotation, if any.
+    """
+    annotation = np.zeros((4, 4, 4), dtype=np.uint16)
+    annotation[1:3, 1:3, 1:3] = 3
+
+    filtered = filter_structures_not_present_in_annotation(
+        structures, annotation, present_ids=present_ids
+    )
+
+    assert [s["id"] for s in filtered] == [1, 2, 3]